@@ -5,22 +5,34 @@ Exposes REST API endpoint for medical report processing
 Setup Instructions:
 1. Install dependencies: pip install -r requirements.txt
 2. Create a .env file in the project root with: GROQ_API_KEY=your_key_here
-3. Run the server: python app.py
+3. Run the server: python app.py (set ENV=prod for multiple workers without auto-reload;
+   WEB_CONCURRENCY sets the worker count)
 4. Open http://localhost:8000 in your browser
 """
 
 import os
-import tempfile
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+import asyncio
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from model import MedicalReportProcessor
-import traceback
+from model import MedicalReportProcessor, InvalidImageError
+from pipeline import ReportPipeline
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 
 # Initialize FastAPI app
 app = FastAPI(title="Medical Report Analyzer", version="1.0.0")
@@ -34,9 +46,176 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Lazy-initialized ML processor (created on first request)
+# ML processor, created and warmed up at startup (or lazily on first request
+# if startup initialization failed). Kept module-global so its Groq
+# connection pool is shared across requests.
 processor = None
 
+# OCR -> LLM pipeline built on the shared processor (started with it)
+pipeline = None
+
+# Thread pool for CPU-bound OCR work (model loading and inference), so it
+# never runs on the event loop
+OCR_WORKERS = min(4, os.cpu_count() or 1)
+OCR_EXECUTOR = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+_pipeline_lock = asyncio.Lock()
+
+# Upload limits
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_REQUEST_SIZE = MAX_UPLOAD_SIZE + 64 * 1024  # allow for multipart framing
+HASH_CHUNK_SIZE = 1024 * 1024  # hash uploads in 1MB chunks
+
+# Analysis results keyed by SHA-256 of the uploaded image, so re-uploads of
+# the same scan (retries, refreshes) skip OCR and the LLM entirely
+RESULT_CACHE = TTLCache(maxsize=2048, ttl=86400)
+
+
+def hash_upload(upload) -> str:
+    """Return the SHA-256 hex digest of a file object, read in chunks"""
+    digest = hashlib.sha256()
+    upload.seek(0)
+    while chunk := upload.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check whether an If-None-Match header value matches the given ETag"""
+    candidates = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return any(tag in (etag, "*") for tag in candidates)
+
+
+def get_processor() -> MedicalReportProcessor:
+    """Return the shared processor, creating it on first use"""
+    global processor
+    if processor is None:
+        try:
+            processor = MedicalReportProcessor()
+        except ValueError as e:
+            # missing API key or client init failure
+            raise HTTPException(status_code=500, detail=str(e))
+    return processor
+
+
+async def get_pipeline() -> ReportPipeline:
+    """Return the shared processing pipeline, starting it on first use"""
+    global pipeline
+    async with _pipeline_lock:
+        if pipeline is None:
+            # Loading the OCR models takes seconds; keep it off the event loop
+            shared_processor = await asyncio.get_running_loop().run_in_executor(OCR_EXECUTOR, get_processor)
+            pipeline = ReportPipeline(shared_processor, OCR_EXECUTOR, ocr_workers=OCR_WORKERS)
+            pipeline.start()
+    return pipeline
+
+
+class _BodyTooLarge(Exception):
+    """Raised by UploadSizeLimitMiddleware once a body passes its limit"""
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware capping the request body size of one upload route
+
+    Oversized requests are rejected with 413 from their Content-Length
+    header before any of the body is read. Bodies without a usable
+    Content-Length (e.g. chunked transfer encoding) are counted as they are
+    received, and the request is aborted with 413 as soon as the running
+    total passes the limit, so the form parser never spools more than that.
+    """
+
+    def __init__(self, app, path: str, max_body_size: int):
+        self.app = app
+        self.path = path
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            try:
+                declared_size = int(content_length)
+            except ValueError:
+                await self._reject(send, 400, "Invalid Content-Length header")
+                return
+            if declared_size > self.max_body_size:
+                await self._reject(send, 413, "File too large. Maximum size is 10MB")
+                return
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    too_large = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # The app may turn the aborted body read into its own error
+            # response; drop it in favour of the 413 below
+            if too_large:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large:
+                raise
+        if too_large and not response_started:
+            await self._reject(send, 413, "File too large. Maximum size is 10MB")
+
+    @staticmethod
+    async def _reject(send, status_code: int, detail: str):
+        """Send a JSON error response directly over ASGI"""
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+app.add_middleware(UploadSizeLimitMiddleware, path="/api/analyze", max_body_size=MAX_REQUEST_SIZE)
+
+
+@app.on_event("startup")
+async def warm_processor():
+    """Load and warm up the OCR models before serving the first request"""
+    try:
+        report_pipeline = await get_pipeline()
+        await asyncio.get_running_loop().run_in_executor(OCR_EXECUTOR, report_pipeline.processor.warm_up)
+    except HTTPException as e:
+        # Leave the processor uninitialized; requests will report the error
+        logger.warning("Processor not initialized at startup: %s", e.detail)
+
+
+@app.on_event("shutdown")
+async def close_processor():
+    """Stop the pipeline and release the processor's pooled HTTP connections"""
+    if pipeline is not None:
+        await pipeline.stop()
+    if processor is not None:
+        await processor.aclose()
+    OCR_EXECUTOR.shutdown(wait=False)
+
 
 @app.get("/")
 async def serve_frontend():
@@ -57,11 +236,12 @@ async def serve_js():
 
 
 @app.post("/api/analyze")
-async def analyze_report(file: UploadFile = File(...)):
+async def analyze_report(request: Request, file: UploadFile = File(...)):
     """
     Endpoint to analyze uploaded medical report image
     
     Args:
+        request: Incoming request (used for the If-None-Match header)
         file: Uploaded image file (JPEG, PNG, etc.)
         
     Returns:
@@ -70,6 +250,10 @@ async def analyze_report(file: UploadFile = File(...)):
         - explanation: Plain-language explanation
         - highlights: Key findings
         - success: Boolean status
+
+        The response carries an ETag derived from the image contents. A
+        repeat upload of the same image is answered from cache, or with
+        304 Not Modified if the client sends that ETag in If-None-Match.
         
     Raises:
         HTTPException: If processing fails
@@ -82,72 +266,102 @@ async def analyze_report(file: UploadFile = File(...)):
             detail=f"Invalid file type. Allowed types: {', '.join(allowed_types)}"
         )
     
-    # Create temporary file to store uploaded image
-    temp_file = None
     try:
-        # Read uploaded file
-        contents = await file.read()
-        
+        # The form parser has already spooled the upload (in memory for
+        # small files, on disk past 1MB), so check its size without reading
+        # it and hand the spooled file straight to OCR - no temp file copy.
+        # Oversized bodies, including chunked ones without Content-Length,
+        # are cut off while streaming by UploadSizeLimitMiddleware at
+        # MAX_REQUEST_SIZE. This check enforces the exact 10MB limit on the
+        # file itself, which the middleware's multipart allowance lets through.
+        upload = file.file
+        upload.seek(0, os.SEEK_END)
+        size = upload.tell()
+        upload.seek(0)
+
         # Validate file size (max 10MB)
-        if len(contents) > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB")
-        
-        # Save to temporary file
-        suffix = os.path.splitext(file.filename)[1] or ".jpg"
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        temp_file.write(contents)
-        temp_file.close()
-        
-        # Ensure processor is initialized (lazy init to allow uvicorn import/test)
-        global processor
-        if processor is None:
-            try:
-                processor = MedicalReportProcessor()
-            except ValueError as e:
-                # missing API key or client init failure
-                raise HTTPException(status_code=500, detail=str(e))
+        if size > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail="File too large. Maximum size is 10MB")
+
+        # Identify the image by content hash (hashlib releases the GIL, so
+        # hash on a worker thread rather than the event loop)
+        cache_key = await asyncio.to_thread(hash_upload, upload)
+        etag = f'"{cache_key}"'
+        headers = {"ETag": etag}
+
+        cached_body = RESULT_CACHE.get(cache_key)
+        if cached_body is not None:
+            if etag_matches(request.headers.get("if-none-match", ""), etag):
+                return Response(status_code=304, headers=headers)
+            return JSONResponse(content=cached_body, headers=headers)
 
         # Process the medical report
-        result = processor.process_medical_report(temp_file.name)
+        report_pipeline = await get_pipeline()
+        result = await report_pipeline.submit(upload)
         
-        return JSONResponse(content={
+        response_body = {
             "success": True,
             "raw_text": result["raw_text"],
             "explanation": result["explanation"],
             "highlights": result["highlights"]
-        })
+        }
+        RESULT_CACHE[cache_key] = response_body
+        return JSONResponse(content=response_body, headers=headers)
     
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
+
+    except InvalidImageError:
+        raise HTTPException(status_code=400, detail="Invalid image")
     
     except Exception as e:
-        # Log the full error for debugging
-        print(f"Error processing report: {str(e)}")
-        print(traceback.format_exc())
+        # Log the full error (with traceback) for debugging
+        logger.exception("Error processing report")
         
         # Return user-friendly error
         raise HTTPException(
             status_code=500,
             detail=f"Failed to process medical report: {str(e)}"
         )
-    
-    finally:
-        # Clean up temporary file
-        if temp_file and os.path.exists(temp_file.name):
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
 
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "Medical Report Analyzer"}
+    cache_stats = processor.llm_cache.stats if processor is not None else {"hits": 0, "misses": 0}
+    return {"status": "healthy", "service": "Medical Report Analyzer", "llm_cache": cache_stats}
 
 
 if __name__ == "__main__":
     import uvicorn
-    # Run the server (uvicorn) - keep this simple for testing
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+
+    prod = os.getenv("ENV", "dev") == "prod"
+    cpu_count = os.cpu_count() or 1
+    # Worker processes for ENV=prod (WEB_CONCURRENCY, default one per core).
+    # Every worker loads its own copy of the OCR models, so memory grows
+    # linearly with this; each also keeps its own in-process caches.
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", cpu_count))) if prod else 1
+
+    # Size the OpenMP pool used by Paddle's CPU kernels, splitting the cores
+    # between workers so N workers don't each start N threads. Both modes
+    # below serve from child processes that import app (and so paddle)
+    # afresh, so setting it here takes effect before paddle is loaded.
+    os.environ.setdefault("OMP_NUM_THREADS", str(max(1, cpu_count // workers)))
+
+    if prod:
+        # Multiple worker processes so OCR isn't limited to a single
+        # interpreter. Each worker builds and warms its own processor at
+        # startup. uvloop and httptools replace the pure-Python event loop
+        # and HTTP parser.
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=workers,
+            loop="uvloop",
+            http="httptools",
+        )
+    else:
+        # Development: single worker with auto-reload on code changes
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
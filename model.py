@@ -1,31 +1,170 @@
 """
 model.py - ML Processing Module
-Contains the MedicalReportProcessor class that handles OCR and local LLM analysis
+Contains the MedicalReportProcessor class that handles OCR and Groq LLM analysis
 """
 
 import os
+import re
+import json
+import logging
+import threading
+import hashlib
+import httpx
+import numpy as np
+from cachetools import TTLCache
 from paddleocr import PaddleOCR
-from PIL import Image
-from groq import Groq
-import traceback
+from PIL import Image, ImageOps
+from groq import AsyncGroq, NOT_GIVEN
+
+
+logger = logging.getLogger(__name__)
+
+GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+# Groq caches prompts by prefix, so everything that is the same for every
+# report (system message, task instructions) must come first and stay
+# byte-identical between requests. Keep these as plain constants - no
+# f-strings or per-request values - and append the OCR text last.
+SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are a helpful medical assistant. Provide clear, non-alarming explanations for medical report contents and list key findings.",
+}
+ANALYSIS_PROMPT_PREFIX = (
+    "Please read the following extracted medical report text and respond with a JSON object with two keys: "
+    "\"explanation\": a plain-language explanation suitable for a patient, concise and avoiding medical jargon where possible; "
+    "\"highlights\": an array of up to 5 short strings, each a key finding or point from the report.\n\nReport Text:\n"
+)
+
+# Leading bytes of the image formats accepted by the API
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"BM",  # BMP
+    b"II*\x00",  # TIFF (little-endian)
+    b"MM\x00*",  # TIFF (big-endian)
+)
+
+# Leading list markers the model sometimes puts on highlight items
+# ("- ", "* ", "•", "1. ", "2) "). Numeric markers need trailing whitespace
+# so values such as "1.5 mg/dL" are left intact.
+_BULLET_RE = re.compile(r"^\s*(?:[\u2022\u00b7]+|[-*]+(?=\s)|\d+[.)](?=\s))\s*")
+
+
+class InvalidImageError(ValueError):
+    """Raised when an uploaded file is not a readable image"""
+
+
+def load_image(image) -> np.ndarray:
+    """
+    Decode an image into the BGR array PaddleOCR expects
+
+    Args:
+        image: Path to an image file, a binary file object (such as an
+            upload's spooled file) or an already-decoded array
+
+    Returns:
+        Image as a BGR uint8 numpy array
+
+    Raises:
+        InvalidImageError: If the data is not a supported, decodable image
+    """
+    if isinstance(image, np.ndarray):
+        return image
+
+    stream = open(image, "rb") if isinstance(image, str) else image
+    try:
+        stream.seek(0)
+        # Cheap header check before handing the data to the decoder
+        if not stream.read(32).startswith(IMAGE_SIGNATURES):
+            raise InvalidImageError("Invalid image")
+        stream.seek(0)
+        try:
+            with Image.open(stream) as img:
+                # Apply the EXIF orientation tag (as cv2.imread does), since
+                # OCR runs without angle classification and phone photos
+                # are often stored rotated
+                rgb = np.asarray(ImageOps.exif_transpose(img).convert("RGB"))
+        except (OSError, ValueError) as e:
+            raise InvalidImageError("Invalid image") from e
+    finally:
+        if stream is not image:
+            stream.close()
+
+    # PIL decodes to RGB; PaddleOCR works on OpenCV-style BGR arrays
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+class LLMCache:
+    """
+    In-process cache for parsed Groq analysis results
+
+    Results are keyed on a SHA-256 of the model, messages and sampling
+    temperature. Only greedy (temperature 0) requests are cached, since those are
+    the ones expected to return identical output for identical input. Callers
+    store results only after they have been parsed and validated, so a
+    malformed reply is never replayed.
+    """
+
+    MAX_CACHEABLE_TEMPERATURE = 0
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 3600):
+        self._store = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def cache_key(self, model: str, messages: list, temperature: float):
+        """Return the cache key for a request, or None if it should not be cached"""
+        if temperature > self.MAX_CACHEABLE_TEMPERATURE:
+            return None
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Look up a cached response, updating hit/miss counters"""
+        if key is None:
+            return None
+        response = self._store.get(key)
+        if response is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+        return response
+
+    def set(self, key, response: dict):
+        """Store a response under the given key"""
+        if key is not None and response:
+            self._store[key] = response
 
 
 class MedicalReportProcessor:
     """
     Encapsulates all ML logic for medical report processing:
     1. OCR extraction using PaddleOCR
-    2. Text generation using local HuggingFace models (T5 or GPT-2)
+    2. Text generation using the Groq chat completions API
     """
     
-    def __init__(self, model_type: str = "t5"):
+    def __init__(self):
         """
-        Initialize OCR and set up local LLM model
-        
-        Args:
-            model_type: "t5" (Google T5) or "gpt2" (OpenAI GPT-2)
+        Initialize OCR and set up the Groq client
+
+        Raises:
+            ValueError: If GROQ_API_KEY is missing or the client cannot be created
         """
         # Initialize PaddleOCR (English language, no angle classification for speed)
-        self.ocr = PaddleOCR(use_angle_cls=False, lang='en', show_log=False)
+        # with MKL-DNN kernels. Inference threads follow OMP_NUM_THREADS, which
+        # the launcher in app.py sets before paddle is imported.
+        self.ocr = PaddleOCR(
+            use_angle_cls=False,
+            lang='en',
+            show_log=False,
+            enable_mkldnn=True,
+            cpu_threads=int(os.getenv("OMP_NUM_THREADS") or os.cpu_count() or 1),
+        )
+        # Paddle predictors are not safe to run from several threads at once;
+        # a single inference already uses this process's cores through cpu_threads
+        self._ocr_lock = threading.Lock()
 
         # Use Groq API for LLM-based analysis
         groq_api_key = os.getenv("GROQ_API_KEY")
@@ -33,180 +172,121 @@ class MedicalReportProcessor:
             raise ValueError("GROQ_API_KEY not found in environment variables. Please set it in your .env file.")
 
         try:
-            self.groq_client = Groq(api_key=groq_api_key)
+            # One pooled HTTP/2 client shared by every request, so warm calls
+            # reuse open connections instead of paying a new TLS handshake
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                http2=True,
+                timeout=30,
+            )
+            # Async client so independent completions can run concurrently
+            self.groq_async = AsyncGroq(api_key=groq_api_key, http_client=self._http)
         except Exception as e:
             raise ValueError(f"Failed to initialize Groq client: {e}")
 
-        print("Groq client initialized successfully")
+        # Cache Groq responses so repeated reports skip the API round-trip
+        self.llm_cache = LLMCache()
+
+        logger.info("Groq client initialized successfully")
     
-    def extract_text_from_image(self, image_path: str) -> str:
+    async def aclose(self):
+        """Close the shared HTTP connection pool"""
+        await self._http.aclose()
+
+    def warm_up(self):
+        """
+        Run OCR once on a blank image so model loading and kernel
+        compilation happen before the first real request
+        """
+        with self._ocr_lock:
+            self.ocr.ocr(np.zeros((64, 64, 3), dtype=np.uint8), cls=False)
+
+    def extract_text_from_image(self, image) -> str:
         """
         Extract text from an image using PaddleOCR
         
         Args:
-            image_path: Path to the image file
+            image: Path to the image file, binary file object or decoded
+                array (see load_image)
             
         Returns:
             Extracted text as a single string
             
         Raises:
+            InvalidImageError: If the file is not a supported image
             Exception: If OCR processing fails
         """
         try:
-            # Verify image can be opened
-            Image.open(image_path).verify()
-            
+            # Decode in memory so PaddleOCR never has to go back to disk
+            img = load_image(image)
+
             # Perform OCR
-            result = self.ocr.ocr(image_path, cls=False)
+            with self._ocr_lock:
+                result = self.ocr.ocr(img, cls=False)
             
             # Extract text from OCR result
             # PaddleOCR returns format: [[[box coordinates], (text, confidence)], ...]
+            # and can emit None entries for boxes it could not recognize
             if not result or not result[0]:
                 return ""
             
-            extracted_lines = []
-            for line in result[0]:
-                text = line[1][0]  # Get text from tuple (text, confidence)
-                extracted_lines.append(text)
-            
-            return "\n".join(extracted_lines)
+            return "\n".join(line[1][0] for line in result[0] if line and line[1])
         
+        except InvalidImageError:
+            raise
         except Exception as e:
-            raise Exception(f"OCR extraction failed: {str(e)}")
+            raise Exception(f"OCR extraction failed: {str(e)}") from e
+
+    async def _get_groq_response(self, messages, temperature=0.7, max_tokens=1024, response_format=None):
+        """
+        Get a non-streamed response from Groq API
+
+        Returns:
+            Tuple of (response text, token usage)
 
-    def _get_groq_response(self, messages, temperature=0.7, max_tokens=1024):
-        """Get response from Groq API with streaming."""
+        Raises:
+            Exception: If the call fails or the reply was cut off at max_tokens
+        """
         try:
-            completion = self.groq_client.chat.completions.create(
-                model="meta-llama/llama-4-scout-17b-16e-instruct",
+            # No streaming: responses are short and awaited in full, and the
+            # non-streamed response carries token usage in one piece
+            completion = await self.groq_async.chat.completions.create(
+                model=GROQ_MODEL,
                 messages=messages,
                 temperature=temperature,
-                max_completion_tokens=max_tokens,
+                max_tokens=max_tokens,
                 top_p=1,
-                stream=True,
+                stream=False,
                 stop=None,
+                response_format=response_format or NOT_GIVEN,
             )
-            response_text = ""
-            for chunk in completion:
-                # defensive access to nested fields
-                try:
-                    delta = chunk.choices[0].delta
-                    if getattr(delta, "content", None):
-                        response_text += delta.content
-                except Exception:
-                    # some SDKs return dicts
-                    try:
-                        if chunk.get("choices") and chunk["choices"][0].get("delta") and chunk["choices"][0]["delta"].get("content"):
-                            response_text += chunk["choices"][0]["delta"]["content"]
-                    except Exception:
-                        # fallback: try to append text if present
-                        try:
-                            if chunk.get("text"):
-                                response_text += chunk.get("text")
-                        except Exception:
-                            pass
-
-            return response_text.strip()
-        except Exception as e:
-            raise Exception(f"Groq API call failed: {str(e)}\n{traceback.format_exc()}")
-    
-    def analyze_with_t5(self, extracted_text: str) -> dict:
-        """
-        Use T5 model to generate explanation and highlights
-        
-        Args:
-            extracted_text: Raw text extracted from the medical report
-            
-        Returns:
-            Dictionary containing 'explanation' and 'highlights' keys
-        """
-        try:
-            # Truncate if too long (T5-small has token limits)
-            max_input_length = 512
-            if len(extracted_text) > max_input_length:
-                extracted_text = extracted_text[:max_input_length]
-            
-            # Task 1: Generate explanation
-            explanation_prompt = f"explain in simple terms: {extracted_text}"
-            explanation_inputs = self.tokenizer.encode(explanation_prompt, return_tensors="pt")
-            explanation_outputs = self.model.generate(explanation_inputs, max_length=150, num_beams=4)
-            explanation = self.tokenizer.decode(explanation_outputs[0], skip_special_tokens=True)
-            
-            # Task 2: Generate highlights
-            highlights_prompt = f"summarize key points from: {extracted_text}"
-            highlights_inputs = self.tokenizer.encode(highlights_prompt, return_tensors="pt")
-            highlights_outputs = self.model.generate(highlights_inputs, max_length=100, num_beams=4)
-            highlights_text = self.tokenizer.decode(highlights_outputs[0], skip_special_tokens=True)
-            
-            # Parse highlights into a list
-            highlights = [h.strip() for h in highlights_text.split(",") if h.strip()]
-            if not highlights:
-                highlights = [highlights_text]
-            
-            # Limit to 5 highlights
-            highlights = highlights[:5]
-            
-            return {
-                "explanation": explanation if explanation else "Unable to generate explanation.",
-                "highlights": highlights
-            }
-        
+            choice = completion.choices[0]
+            if choice.finish_reason == "length":
+                raise ValueError(f"response truncated at max_tokens={max_tokens}")
+            return (choice.message.content or "").strip(), completion.usage
         except Exception as e:
-            raise Exception(f"T5 analysis failed: {str(e)}")
-    
-    def analyze_with_gpt2(self, extracted_text: str) -> dict:
-        """
-        Use GPT-2 model to generate explanation and highlights
-        
-        Args:
-            extracted_text: Raw text extracted from the medical report
-            
-        Returns:
-            Dictionary containing 'explanation' and 'highlights' keys
-        """
-        try:
-            # Truncate if too long (GPT-2 has token limits)
-            max_input_length = 256
-            if len(extracted_text) > max_input_length:
-                extracted_text = extracted_text[:max_input_length]
-            
-            # Task 1: Generate explanation
-            explanation_prompt = f"Medical Report Summary:\n{extracted_text}\n\nExplanation:"
-            explanation_output = self.pipeline(explanation_prompt, do_sample=True, top_p=0.9)
-            explanation = explanation_output[0]["generated_text"]
-            
-            # Extract only the generated part (remove prompt)
-            if "Explanation:" in explanation:
-                explanation = explanation.split("Explanation:")[-1].strip()
-            
-            # Task 2: Generate highlights
-            highlights_prompt = f"Key findings from:\n{extracted_text}\n\nKey points:"
-            highlights_output = self.pipeline(highlights_prompt, do_sample=True, top_p=0.9)
-            highlights_text = highlights_output[0]["generated_text"]
-            
-            # Extract only the generated part
-            if "Key points:" in highlights_text:
-                highlights_text = highlights_text.split("Key points:")[-1].strip()
-            
-            # Parse highlights into a list
-            highlights = [h.strip() for h in highlights_text.split("\n") if h.strip()]
-            if not highlights:
-                highlights = [highlights_text]
-            
-            # Limit to 5 highlights
-            highlights = highlights[:5]
-            
-            return {
-                "explanation": explanation if explanation else "Unable to generate explanation.",
-                "highlights": highlights
-            }
-        
-        except Exception as e:
-            raise Exception(f"GPT-2 analysis failed: {str(e)}")
+            raise Exception(f"Groq API call failed: {str(e)}") from e
+
+    @staticmethod
+    def _log_prompt_cache_usage(usage):
+        """Log how much of the prompt Groq served from its prefix cache."""
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        if not prompt_tokens:
+            return
+        # The pinned SDK doesn't model prompt_tokens_details, so it comes
+        # through as a plain dict of extra fields
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached_tokens = details.get("cached_tokens")
+        else:
+            cached_tokens = getattr(details, "cached_tokens", None)
+        cached_tokens = cached_tokens or getattr(usage, "cached_tokens", None) or 0
+        logger.info("cache_hit_rate=%.2f cached_tokens=%d prompt_tokens=%d",
+                    cached_tokens / prompt_tokens, cached_tokens, prompt_tokens)
     
-    def analyze_with_llm(self, extracted_text: str) -> dict:
+    async def analyze_with_llm(self, extracted_text: str) -> dict:
         """
-        Route to appropriate local model analysis
+        Generate a patient-facing explanation and key highlights with Groq
         
         Args:
             extracted_text: Raw text extracted from the medical report
@@ -214,66 +294,63 @@ class MedicalReportProcessor:
         Returns:
             Dictionary containing 'explanation' and 'highlights' keys
         """
-        # Use Groq chat-style API to get explanation and highlights
+        # Use Groq chat-style API to get explanation and highlights in a single JSON response
         try:
-            system_msg = {"role": "system", "content": "You are a helpful medical assistant. Provide clear, non-alarming explanations for medical report contents and list key findings."}
+            messages = [SYSTEM_MSG, {"role": "user", "content": ANALYSIS_PROMPT_PREFIX + extracted_text}]
+            temperature = 0
 
-            # Explanation
-            explanation_prompt = (
-                "Please read the following extracted medical report text and provide a plain-language explanation suitable for a patient. "
-                "Be concise and avoid medical jargon where possible.\n\nReport Text:\n" + extracted_text
-            )
-            explanation_messages = [system_msg, {"role": "user", "content": explanation_prompt}]
-            explanation = self._get_groq_response(explanation_messages, temperature=0.3, max_tokens=512)
+            # Repeated reports are served from cache without calling Groq
+            cache_key = self.llm_cache.cache_key(GROQ_MODEL, messages, temperature)
+            cached = self.llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
 
-            # Highlights
-            highlights_prompt = (
-                "Please list up to 5 key findings or points from the report. Return each item on a new line.\n\nReport Text:\n" + extracted_text
+            response_text, usage = await self._get_groq_response(
+                messages, temperature=temperature, max_tokens=768, response_format={"type": "json_object"}
             )
-            highlights_messages = [system_msg, {"role": "user", "content": highlights_prompt}]
-            highlights_text = self._get_groq_response(highlights_messages, temperature=0.3, max_tokens=256)
+            self._log_prompt_cache_usage(usage)
 
-            # Parse highlights into a list (split on newlines or commas)
-            highlights = []
-            if highlights_text:
-                # prefer newlines
-                if "\n" in highlights_text:
-                    highlights = [h.strip('-• \t') for h in highlights_text.splitlines() if h.strip()]
-                else:
-                    highlights = [h.strip() for h in highlights_text.split(',') if h.strip()]
+            data = json.loads(response_text)
+            if not isinstance(data, dict):
+                raise ValueError(f"expected a JSON object, got {type(data).__name__}")
 
-            if not highlights:
-                highlights = [highlights_text] if highlights_text else []
+            explanation = str(data.get("explanation") or "").strip()
+            highlights = data.get("highlights") or []
+            if isinstance(highlights, str):
+                highlights = highlights.splitlines()
+            elif not isinstance(highlights, list):
+                raise ValueError(f"expected 'highlights' to be a list, got {type(highlights).__name__}")
 
-            # Limit to 5
-            highlights = highlights[:5]
+            # Strip list markers and limit to 5
+            highlights = [_BULLET_RE.sub("", str(h)).strip() for h in highlights]
+            highlights = [h for h in highlights if h][:5]
 
-            return {
+            analysis = {
                 "explanation": explanation if explanation else "Unable to generate explanation.",
                 "highlights": highlights
             }
+            # Only cache once the reply has parsed and validated
+            self.llm_cache.set(cache_key, analysis)
+            return analysis
         except Exception as e:
-            raise Exception(f"LLM analysis (Groq) failed: {str(e)}")
+            raise Exception(f"LLM analysis (Groq) failed: {str(e)}") from e
     
-    def process_medical_report(self, image_path: str) -> dict:
+    async def analyze_extracted_text(self, raw_text: str) -> dict:
         """
-        Complete pipeline: OCR extraction + local LLM analysis
-        
+        Build the report result for already-extracted OCR text
+
+        OCR itself is blocking, so callers run extract_text_from_image on a
+        thread pool first (see ReportPipeline) and pass the text in here
+
         Args:
-            image_path: Path to the medical report image
-            
+            raw_text: Text extracted from the medical report
+
         Returns:
             Dictionary containing:
             - raw_text: Extracted text from OCR
-            - explanation: Plain-language explanation from local model
-            - highlights: Key highlights from local model
-            
-        Raises:
-            Exception: If any step fails
+            - explanation: Plain-language explanation from the LLM
+            - highlights: Key highlights from the LLM
         """
-        # Step 1: Extract text
-        raw_text = self.extract_text_from_image(image_path)
-        
         if not raw_text.strip():
             return {
                 "raw_text": "",
@@ -281,8 +358,7 @@ class MedicalReportProcessor:
                 "highlights": []
             }
         
-        # Step 2: Analyze with local LLM
-        analysis = self.analyze_with_llm(raw_text)
+        analysis = await self.analyze_with_llm(raw_text)
         
         return {
             "raw_text": raw_text,
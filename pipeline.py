@@ -0,0 +1,102 @@
+"""
+pipeline.py - Report Processing Pipeline
+Runs OCR and LLM analysis as separate stages so concurrent uploads overlap
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from model import MedicalReportProcessor
+
+
+class ReportPipeline:
+    """
+    Asynchronous three-stage pipeline for medical report processing:
+    1. File receive: the request handler submits an image and awaits the result
+    2. OCR: workers pull jobs from a bounded queue and run PaddleOCR on the OCR thread pool
+    3. LLM: each OCR result is handed to an async Groq analysis task
+
+    An OCR worker moves on to the next image as soon as it has handed off
+    the extracted text, so OCR for one upload overlaps the LLM calls of
+    another instead of every request running both steps back to back.
+    """
+
+    def __init__(self, processor: MedicalReportProcessor, ocr_executor: Executor, ocr_workers: int = 1, max_pending: int = 32):
+        """
+        Args:
+            processor: Shared processor used for OCR and LLM analysis
+            ocr_executor: Thread pool that runs the blocking OCR calls
+            ocr_workers: Number of OCR workers; should match the executor's size
+            max_pending: Maximum number of uploads waiting for OCR before
+                submitters are made to wait
+        """
+        self.processor = processor
+        self.ocr_workers = ocr_workers
+        self._ocr_pool = ocr_executor
+        self._ocr_queue = asyncio.Queue(maxsize=max_pending)
+        self._workers = []
+        self._llm_tasks = set()
+
+    def start(self):
+        """Start the OCR workers on the running event loop"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._ocr_worker()) for _ in range(self.ocr_workers)]
+
+    async def stop(self):
+        """Stop the workers and wait for in-flight LLM analyses to finish"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, *self._llm_tasks, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, image) -> dict:
+        """
+        Queue an image for processing and wait for its result
+
+        Args:
+            image: Medical report image; a path, binary file object or
+                decoded array, decoded on the OCR thread pool
+
+        Returns:
+            Same dictionary as MedicalReportProcessor.analyze_extracted_text
+
+        Raises:
+            Exception: If OCR or LLM analysis fails
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._ocr_queue.put((image, future))
+        return await future
+
+    async def _ocr_worker(self):
+        """Stage 2: run OCR off the event loop, then hand off to the LLM stage"""
+        loop = asyncio.get_running_loop()
+        while True:
+            image, future = await self._ocr_queue.get()
+            try:
+                # Skip jobs whose request has already gone away
+                if future.done():
+                    continue
+                try:
+                    raw_text = await loop.run_in_executor(
+                        self._ocr_pool, self.processor.extract_text_from_image, image
+                    )
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+
+                task = asyncio.create_task(self._analyze(raw_text, future))
+                self._llm_tasks.add(task)
+                task.add_done_callback(self._llm_tasks.discard)
+            finally:
+                self._ocr_queue.task_done()
+
+    async def _analyze(self, raw_text: str, future: asyncio.Future):
+        """Stage 3: LLM analysis of the extracted text"""
+        try:
+            result = await self.processor.analyze_extracted_text(raw_text)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)